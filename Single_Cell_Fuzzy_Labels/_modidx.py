@@ -26,13 +26,85 @@ d = { 'settings': { 'branch': 'main',
             'Single_Cell_Fuzzy_Labels.census_dl': { 'Single_Cell_Fuzzy_Labels.census_dl.download_census_data': ( 'download_embeddings_census.html#download_census_data',
                                                                                                                  'Single_Cell_Fuzzy_Labels/census_dl.py')},
             'Single_Cell_Fuzzy_Labels.core': {'Single_Cell_Fuzzy_Labels.core.foo': ('core.html#foo', 'Single_Cell_Fuzzy_Labels/core.py')},
-            'Single_Cell_Fuzzy_Labels.harmonise': { 'Single_Cell_Fuzzy_Labels.harmonise.map_labels_to_categories': ( 'label_set_harmonisation.html#map_labels_to_categories',
+            'Single_Cell_Fuzzy_Labels.harmonise': { 'Single_Cell_Fuzzy_Labels.harmonise._build_messages': ( 'label_set_harmonisation.html#_build_messages',
+                                                                                                            'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._build_request': ( 'label_set_harmonisation.html#_build_request',
+                                                                                                           'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._cache_get': ( 'label_set_harmonisation.html#_cache_get',
+                                                                                                       'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._cache_key': ( 'label_set_harmonisation.html#_cache_key',
+                                                                                                       'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._cache_put': ( 'label_set_harmonisation.html#_cache_put',
+                                                                                                       'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._close_at_shutdown': ( 'label_set_harmonisation.html#_close_at_shutdown',
+                                                                                                               'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._get_async_client': ( 'label_set_harmonisation.html#_get_async_client',
+                                                                                                              'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._get_client': ( 'label_set_harmonisation.html#_get_client',
+                                                                                                        'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._match_sharded': ( 'label_set_harmonisation.html#_match_sharded',
+                                                                                                           'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._merge_shards': ( 'label_set_harmonisation.html#_merge_shards',
+                                                                                                          'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._one': ( 'label_set_harmonisation.html#_one',
+                                                                                                 'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._parse_completion': ( 'label_set_harmonisation.html#_parse_completion',
+                                                                                                              'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._parse_content': ( 'label_set_harmonisation.html#_parse_content',
+                                                                                                           'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._resolve_api_key': ( 'label_set_harmonisation.html#_resolve_api_key',
+                                                                                                             'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._response_format': ( 'label_set_harmonisation.html#_response_format',
+                                                                                                             'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise._shards': ( 'label_set_harmonisation.html#_shards',
+                                                                                                    'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise.close_async_client': ( 'label_set_harmonisation.html#close_async_client',
+                                                                                                               'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise.close_client': ( 'label_set_harmonisation.html#close_client',
+                                                                                                         'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise.map_labels_to_categories': ( 'label_set_harmonisation.html#map_labels_to_categories',
                                                                                                                      'Single_Cell_Fuzzy_Labels/harmonise.py'),
                                                     'Single_Cell_Fuzzy_Labels.harmonise.map_old_labels_to_new': ( 'label_set_harmonisation.html#map_old_labels_to_new',
                                                                                                                   'Single_Cell_Fuzzy_Labels/harmonise.py'),
                                                     'Single_Cell_Fuzzy_Labels.harmonise.match_cell_labels': ( 'label_set_harmonisation.html#match_cell_labels',
-                                                                                                              'Single_Cell_Fuzzy_Labels/harmonise.py')},
-            'Single_Cell_Fuzzy_Labels.transfer': { 'Single_Cell_Fuzzy_Labels.transfer.assign_labels_by_nearest_centroid': ( 'knn_label_transfer.html#assign_labels_by_nearest_centroid',
+                                                                                                              'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise.match_cell_labels_async': ( 'label_set_harmonisation.html#match_cell_labels_async',
+                                                                                                                    'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise.match_cell_labels_batch': ( 'label_set_harmonisation.html#match_cell_labels_batch',
+                                                                                                                    'Single_Cell_Fuzzy_Labels/harmonise.py'),
+                                                    'Single_Cell_Fuzzy_Labels.harmonise.match_cell_labels_many': ( 'label_set_harmonisation.html#match_cell_labels_many',
+                                                                                                                   'Single_Cell_Fuzzy_Labels/harmonise.py')},
+            'Single_Cell_Fuzzy_Labels.transfer': { 'Single_Cell_Fuzzy_Labels.transfer._add': ( 'knn_label_transfer.html#_add',
+                                                                                               'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._array_module': ( 'knn_label_transfer.html#_array_module',
+                                                                                                        'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._as_faiss_array': ( 'knn_label_transfer.html#_as_faiss_array',
+                                                                                                          'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._centroids': ( 'knn_label_transfer.html#_centroids',
+                                                                                                     'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._encode_labels': ( 'knn_label_transfer.html#_encode_labels',
+                                                                                                         'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._flat_index': ( 'knn_label_transfer.html#_flat_index',
+                                                                                                      'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._float32': ( 'knn_label_transfer.html#_float32',
+                                                                                                   'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._get_gpu_resources': ( 'knn_label_transfer.html#_get_gpu_resources',
+                                                                                                             'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._majority_vote': ( 'knn_label_transfer.html#_majority_vote',
+                                                                                                         'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._numba_vote_kernel': ( 'knn_label_transfer.html#_numba_vote_kernel',
+                                                                                                             'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._pq_code_size': ( 'knn_label_transfer.html#_pq_code_size',
+                                                                                                        'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._reference_index': ( 'knn_label_transfer.html#_reference_index',
+                                                                                                           'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._search': ( 'knn_label_transfer.html#_search',
+                                                                                                  'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._search_to_gpu': ( 'knn_label_transfer.html#_search_to_gpu',
+                                                                                                         'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer._weighted_vote': ( 'knn_label_transfer.html#_weighted_vote',
+                                                                                                         'Single_Cell_Fuzzy_Labels/transfer.py'),
+                                                   'Single_Cell_Fuzzy_Labels.transfer.assign_labels_by_nearest_centroid': ( 'knn_label_transfer.html#assign_labels_by_nearest_centroid',
                                                                                                                             'Single_Cell_Fuzzy_Labels/transfer.py'),
                                                    'Single_Cell_Fuzzy_Labels.transfer.calculate_centroids': ( 'knn_label_transfer.html#calculate_centroids',
                                                                                                               'Single_Cell_Fuzzy_Labels/transfer.py'),
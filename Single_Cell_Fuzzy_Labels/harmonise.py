@@ -1,57 +1,229 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/03_Label_Set_harmonisation.ipynb.
 
 # %% auto 0
-__all__ = ['match_cell_labels', 'map_old_labels_to_new', 'map_labels_to_categories']
+__all__ = ['close_client', 'match_cell_labels', 'map_old_labels_to_new', 'close_async_client', 'match_cell_labels_async',
+           'match_cell_labels_many', 'match_cell_labels_batch', 'map_labels_to_categories']
 
 # %% ../nbs/03_Label_Set_harmonisation.ipynb 3
-def match_cell_labels(existing_labels_set:set, # A set of existing cell type labels
-                      predicted_labels_set:set, # A set of predicted cell type labels
-                      openai_api_key:str=None  # The API key for OpenAI. If not provided, it will be taken from the environment variable 'OPENAI_API_KEY'
-                      ) -> dict: # A dictionary representing the JSON object with matched labels.
-    
-    """
-    This function matches cell type labels from two sets using OpenAI's GPT-4 model.
-    """
-    
-    # Import necessary libraries
-    from openai import OpenAI
-    import os
-    import json
-    
-    # Use the provided API key or get it from the environment variable
+import os
+import json
+import time
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+
+# %% ../nbs/03_Label_Set_harmonisation.ipynb 4
+_SYSTEM_PROMPT = "As an expert Cell Biologist with extensive knowledge in comparing and relating various cell classification types, you will be presented with two lists of cell type labels. Your objective is to accurately match each label from the first list with its most suitable counterpart in the second list. It is important to note that multiple labels from the first list may correspond to a single label in the second list, reflecting differences in annotation resolution. Your responses should demonstrate the depth of your analytical and reasoning skills, underpinned by your comprehensive scientific understanding and the insights you've acquired from thorough research in this field. Please submit your answers in the form of a JSON object."
+
+
+def _resolve_api_key(openai_api_key:str=None # The API key for OpenAI. If not provided, it will be taken from the environment variable 'OPENAI_API_KEY'
+                     ) -> str: # The API key to use
+    "Returns the provided API key or falls back to the 'OPENAI_API_KEY' environment variable."
     api_key = openai_api_key or os.getenv('OPENAI_API_KEY')
     if api_key is None:
         raise ValueError("An OpenAI API key must be provided either as an argument or as an environment variable 'OPENAI_API_KEY'.")
+    return api_key
+
 
+def _build_messages(existing_labels_set:set, # A set of existing cell type labels
+                    predicted_labels_set:set # A set of predicted cell type labels
+                    ) -> list: # The chat messages to send to the OpenAI model
+    "Constructs the chat messages used to match two sets of cell type labels."
     # Construct the prompt for the OpenAI model
     prompt = f"First set of labels: {predicted_labels_set}. Second set of labels: {existing_labels_set}. " \
              "Associate each label in the first set with labels in the second set, based on your knowledge of cell type similarity, " \
              "as accurately as possible. Return answer as JSON object"
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+
+_MODEL = "gpt-4o-mini-2024-07-18"
+_CACHE_DIR = "~/.cache/Single_Cell_Fuzzy_Labels/match_cell_labels"
+# Bump whenever the prompt or the response format changes, so results cached for the old request are not served
+_CACHE_VERSION = 2
+
 
-    # Initialize the OpenAI client with the API key
-    client = OpenAI(api_key=api_key)
-
-    # Create a completion request to the OpenAI API
-    completion = client.chat.completions.create(
-        model="gpt-4-1106-preview",
-        messages=[
-            {"role": "system", "content":"As an expert Cell Biologist with extensive knowledge in comparing and relating various cell classification types, you will be presented with two lists of cell type labels. Your objective is to accurately match each label from the first list with its most suitable counterpart in the second list. It is important to note that multiple labels from the first list may correspond to a single label in the second list, reflecting differences in annotation resolution. Your responses should demonstrate the depth of your analytical and reasoning skills, underpinned by your comprehensive scientific understanding and the insights you've acquired from thorough research in this field. Please submit your answers in the form of a JSON object."},
-            {"role": "user", "content": prompt}
-        ],
-        response_format={"type": "json_object"}
+# Strict structured outputs reject schemas with more than 1000 enum values, or with an enum of more than 250 values
+# whose total length exceeds 15,000 characters.
+_MAX_ENUM_VALUES = 1000
+_MAX_LONG_ENUM_VALUES = 250
+_MAX_LONG_ENUM_LENGTH = 15000
+
+
+def _response_format(existing_labels_set:set, # A set of existing cell type labels
+                     predicted_labels_set:set # A set of predicted cell type labels
+                     ) -> dict: # The structured output format of the chat completion request
+    "Constructs a strict JSON schema mapping every predicted label to a list of existing labels, so the model always returns valid, complete JSON."
+    existing_labels = sorted(str(label) for label in existing_labels_set)
+    predicted_labels = sorted(str(label) for label in predicted_labels_set)
+    # The existing labels are defined once and referenced by every property, since the enum limits apply to the whole
+    # schema rather than per property. Label sets too large for an enum are matched as plain strings instead.
+    existing_label = {"type": "string"}
+    if len(existing_labels) <= _MAX_ENUM_VALUES and (len(existing_labels) <= _MAX_LONG_ENUM_VALUES or
+                                                     sum(map(len, existing_labels)) <= _MAX_LONG_ENUM_LENGTH):
+        existing_label["enum"] = existing_labels
+    schema = {
+        "type": "object",
+        "properties": {label: {"type": "array", "items": {"$ref": "#/$defs/existing_label"}} for label in predicted_labels},
+        "required": predicted_labels,
+        "additionalProperties": False,
+        "$defs": {"existing_label": existing_label}
+    }
+    return {"type": "json_schema", "json_schema": {"name": "label_map", "strict": True, "schema": schema}}
+
+
+def _build_request(existing_labels_set:set, # A set of existing cell type labels
+                   predicted_labels_set:set # A set of predicted cell type labels
+                   ) -> dict: # The body of the chat completion request
+    "Constructs the chat completion request used to match two sets of cell type labels."
+    return dict(
+        model=_MODEL,
+        messages=_build_messages(existing_labels_set, predicted_labels_set),
+        response_format=_response_format(existing_labels_set, predicted_labels_set)
     )
 
-    # Extract the response from the completion object
-    bingo = completion.choices[0].message
 
-    # Parse the response as JSON
+def _parse_content(content:str # The message content returned by the OpenAI model
+                   ) -> dict: # The parsed JSON object, or None if the content is not valid JSON
+    "Parses the JSON object returned by the OpenAI model, or returns None if it is not valid JSON (e.g. if the model refused to answer)."
     try:
-        json_data = json.loads(str(bingo.content))
+        json_data = json.loads(str(content))
         return json_data
     except json.JSONDecodeError:
         print("The message is not in JSON format.")
         return None
 
+
+def _parse_completion(completion) -> dict:
+    "Parses the JSON object in a chat completion, or returns None if it is not valid JSON."
+    # Extract the response from the completion object
+    bingo = completion.choices[0].message
+    return _parse_content(bingo.content)
+
+
+def _cache_key(existing_labels_set:set, # A set of existing cell type labels
+               predicted_labels_set:set # A set of predicted cell type labels
+               ) -> str: # A hash identifying the pair of label sets, the model and the cache version
+    "Returns a cache key that does not depend on the order of the labels in each set."
+    # Labels are compared as strings, since sets built from e.g. an AnnData `obs` column can mix strings with a NaN float
+    canonical = json.dumps(sorted(map(str, existing_labels_set))) + "|" + json.dumps(sorted(map(str, predicted_labels_set))) + \
+                "|" + _MODEL + "|" + str(_CACHE_VERSION)
+    return hashlib.blake2b(canonical.encode()).hexdigest()
+
+
+def _cache_get(key:str # A key returned by `_cache_key`
+               ) -> dict: # The cached matched labels, or None if there are none
+    "Reads a cached `match_cell_labels` result from disk."
+    path = os.path.join(os.path.expanduser(_CACHE_DIR), f"{key}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _cache_put(key:str, # A key returned by `_cache_key`
+               json_data:dict # The matched labels to cache
+               ):
+    "Writes a `match_cell_labels` result to disk. Results that failed to parse are not cached."
+    if json_data is None:
+        return
+    cache_dir = os.path.expanduser(_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first so that concurrent readers never see a partial result
+    tmp_path = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(json_data, f)
+    os.replace(tmp_path, os.path.join(cache_dir, f"{key}.json"))
+
+
+# Rate limit (429), server (5xx), connection and timeout errors are retried by the OpenAI client with exponential
+# backoff and jitter, honouring the `Retry-After` header, so a transient error does not abort a whole harmonisation run.
+_MAX_RETRIES = 6
+_client = None
+_client_key = None
+
+
+def _get_client(api_key:str # The API key for OpenAI
+                ):
+    "Returns a module-level `OpenAI` client, so its pooled keep-alive connections are reused across calls."
+    global _client, _client_key
+    if _client is None or _client_key != api_key:
+        close_client()
+        _client = OpenAI(api_key=api_key, max_retries=_MAX_RETRIES,
+                         http_client=httpx.Client(limits=httpx.Limits(max_keepalive_connections=20, max_connections=100), timeout=60))
+        _client_key = api_key
+    return _client
+
+
+def close_client():
+    "Closes the module-level `OpenAI` client and its connection pool."
+    global _client, _client_key
+    if _client is not None:
+        _client.close()
+    _client, _client_key = None, None
+
+
+def _shards(labels_set:set, # A set of cell type labels
+            shard_size:int=50 # The maximum number of labels per shard
+            ) -> list: # A list of sets of at most `shard_size` labels
+    "Splits a set of labels into shards, in a deterministic order so that each shard is cached consistently."
+    labels = sorted(labels_set, key=str)
+    return [set(labels[i:i + shard_size]) for i in range(0, len(labels), shard_size)] or [set()]
+
+
+def _merge_shards(results:list # The matched labels of each shard
+                  ) -> dict: # The matched labels of all shards, or None if any shard failed
+    "Merges the matched labels of each shard into a single dictionary."
+    if any(json_data is None for json_data in results):
+        return None
+    return {label: match for json_data in results for label, match in json_data.items()}
+
+
+def match_cell_labels(existing_labels_set:set, # A set of existing cell type labels
+                      predicted_labels_set:set, # A set of predicted cell type labels
+                      openai_api_key:str=None, # The API key for OpenAI. If not provided, it will be taken from the environment variable 'OPENAI_API_KEY'
+                      force_refresh:bool=False, # Whether to query the model even if a cached result exists for these label sets
+                      shard_size:int=50, # The maximum number of predicted labels matched per request. Larger sets are split over concurrent requests.
+                      concurrency:int=50 # The maximum number of requests in flight at once
+                      ) -> dict: # A dictionary representing the JSON object with matched labels.
+    
+    """
+    This function matches cell type labels from two sets using OpenAI's GPT-4o mini model.
+    """
+    
+    # Match the predicted labels in shards, so that the prompt and response size stay bounded for large label sets.
+    # Every shard is matched against all the existing labels. Use the cached result for each shard, if any.
+    shards = _shards(predicted_labels_set, shard_size)
+    keys = [_cache_key(existing_labels_set, shard) for shard in shards]
+    results = [None if force_refresh else _cache_get(key) for key in keys]
+    pending = [i for i, json_data in enumerate(results) if json_data is None]
+    if not pending:
+        return _merge_shards(results)
+
+    # Reuse the pooled OpenAI client for the provided API key, or the one in the environment variable
+    client = _get_client(_resolve_api_key(openai_api_key))
+
+    def match_shard(i):
+        # Create a completion request to the OpenAI API
+        completion = client.chat.completions.create(**_build_request(existing_labels_set, shards[i]))
+        json_data = _parse_completion(completion)
+        _cache_put(keys[i], json_data)
+        return json_data
+
+    # Send the shards concurrently over the pooled connections, so latency stays close to that of a single shard
+    with ThreadPoolExecutor(max_workers=min(len(pending), concurrency)) as executor:
+        for i, json_data in zip(pending, executor.map(match_shard, pending)):
+            results[i] = json_data
+
+    return _merge_shards(results)
+
 #| export
 def map_old_labels_to_new(old_labels: list, # A list of old labels that need to be mapped to new labels
                           label_mapping: dict # A dictionary where keys are old labels and values are new labels
@@ -75,7 +247,169 @@ def map_old_labels_to_new(old_labels: list, # A list of old labels that need to
 
     return mapped_list
 
-# %% ../nbs/03_Label_Set_harmonisation.ipynb 4
+# %% ../nbs/03_Label_Set_harmonisation.ipynb 7
+_async_client = None
+_async_client_key = None
+_async_client_loop = None
+_async_client_closer = None
+
+
+async def _close_at_shutdown(client # The `AsyncOpenAI` client to close
+                            ):
+    "Closes `client`, if it is still the module-level client, when its event loop shuts down its async generators, as `asyncio.run` does before closing the loop."
+    try:
+        yield
+    finally:
+        if _async_client is client:
+            await close_async_client()
+
+
+async def _get_async_client(api_key:str # The API key for OpenAI
+                            ):
+    "Returns a module-level `AsyncOpenAI` client for the running event loop, so its pooled connections are reused across calls."
+    global _async_client, _async_client_key, _async_client_loop, _async_client_closer
+    # An `httpx.AsyncClient` is bound to the event loop it was first used on, so it is rebuilt for a new loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_key != api_key or _async_client_loop is not loop:
+        # Close the stale client on the loop it belongs to, so its connection pool is not leaked
+        if _async_client is not None and _async_client_loop is loop:
+            await _async_client.close()
+        elif _async_client is not None and not _async_client_loop.is_closed():
+            asyncio.run_coroutine_threadsafe(_async_client.close(), _async_client_loop)
+        _async_client = AsyncOpenAI(api_key=api_key, max_retries=_MAX_RETRIES,
+                                    http_client=httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=20, max_connections=100), timeout=60))
+        _async_client_key, _async_client_loop = api_key, loop
+        # The loop only holds weak references to its async generators, so keep the closer alive until it runs
+        _async_client_closer = _close_at_shutdown(_async_client)
+        await _async_client_closer.asend(None)
+    return _async_client
+
+
+async def close_async_client():
+    "Closes the module-level `AsyncOpenAI` client and its connection pool. This happens automatically when an `asyncio.run` loop ends; call it yourself for event loops closed without `loop.shutdown_asyncgens()`."
+    global _async_client, _async_client_key, _async_client_loop, _async_client_closer
+    client = _async_client
+    _async_client, _async_client_key, _async_client_loop, _async_client_closer = None, None, None, None
+    if client is not None:
+        await client.close()
+
+
+async def _one(sem:asyncio.Semaphore, # Semaphore bounding the number of requests in flight
+               client, # An `AsyncOpenAI` client
+               existing_labels_set:set, # A set of existing cell type labels
+               predicted_labels_set:set, # A set of predicted cell type labels
+               force_refresh:bool=False # Whether to query the model even if a cached result exists for these label sets
+               ) -> dict: # A dictionary representing the JSON object with matched labels.
+    "Matches a single pair of label sets once a slot in `sem` is available."
+    key = _cache_key(existing_labels_set, predicted_labels_set)
+    if not force_refresh:
+        json_data = _cache_get(key)
+        if json_data is not None:
+            return json_data
+
+    async with sem:
+        completion = await client.chat.completions.create(**_build_request(existing_labels_set, predicted_labels_set))
+    json_data = _parse_completion(completion)
+    _cache_put(key, json_data)
+    return json_data
+
+
+async def _match_sharded(sem:asyncio.Semaphore, # Semaphore bounding the number of requests in flight
+                         client, # An `AsyncOpenAI` client
+                         existing_labels_set:set, # A set of existing cell type labels
+                         predicted_labels_set:set, # A set of predicted cell type labels
+                         shard_size:int=50, # The maximum number of predicted labels matched per request
+                         force_refresh:bool=False # Whether to query the model even if a cached result exists for these label sets
+                         ) -> dict: # A dictionary representing the JSON object with matched labels.
+    "Matches the shards of the predicted labels concurrently against all the existing labels, and merges the results."
+    results = await asyncio.gather(*[_one(sem, client, existing_labels_set, shard, force_refresh)
+                                     for shard in _shards(predicted_labels_set, shard_size)])
+    return _merge_shards(results)
+
+
+async def match_cell_labels_async(existing_labels_set:set, # A set of existing cell type labels
+                                  predicted_labels_set:set, # A set of predicted cell type labels
+                                  openai_api_key:str=None, # The API key for OpenAI. If not provided, it will be taken from the environment variable 'OPENAI_API_KEY'
+                                  client=None, # An `AsyncOpenAI` client to use. If not provided, the pooled module-level client is used.
+                                  force_refresh:bool=False, # Whether to query the model even if a cached result exists for these label sets
+                                  shard_size:int=50, # The maximum number of predicted labels matched per request. Larger sets are split over concurrent requests.
+                                  concurrency:int=50 # The maximum number of requests in flight at once
+                                  ) -> dict: # A dictionary representing the JSON object with matched labels.
+    """
+    Asynchronous version of `match_cell_labels`.
+    """
+    client = client or await _get_async_client(_resolve_api_key(openai_api_key))
+    sem = asyncio.Semaphore(concurrency)
+    return await _match_sharded(sem, client, existing_labels_set, predicted_labels_set, shard_size, force_refresh)
+
+
+async def match_cell_labels_many(pairs:List[Tuple[set, set]], # A list of (existing_labels_set, predicted_labels_set) pairs
+                                 openai_api_key:str=None, # The API key for OpenAI. If not provided, it will be taken from the environment variable 'OPENAI_API_KEY'
+                                 concurrency:int=50, # The maximum number of requests in flight at once
+                                 client=None, # An `AsyncOpenAI` client to use. If not provided, the pooled module-level client is used.
+                                 force_refresh:bool=False, # Whether to query the model even for pairs with a cached result
+                                 shard_size:int=50 # The maximum number of predicted labels matched per request. Larger sets are split over concurrent requests.
+                                 ) -> List[dict]: # A list of dictionaries with matched labels, in the same order as `pairs`.
+    """
+    Matches many pairs of cell type label sets concurrently using OpenAI's GPT-4o mini model.
+    """
+    client = client or await _get_async_client(_resolve_api_key(openai_api_key))
+    sem = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_match_sharded(sem, client, e, p, shard_size, force_refresh) for e, p in pairs])
+
+
+# %% ../nbs/03_Label_Set_harmonisation.ipynb 9
+def match_cell_labels_batch(pairs:List[Tuple[set, set]], # A list of (existing_labels_set, predicted_labels_set) pairs
+                            openai_api_key:str=None, # The API key for OpenAI. If not provided, it will be taken from the environment variable 'OPENAI_API_KEY'
+                            poll_interval:float=30, # The number of seconds to wait between checks of the batch status
+                            force_refresh:bool=False, # Whether to query the model even for pairs with a cached result
+                            shard_size:int=50 # The maximum number of predicted labels matched per request. Larger sets are split over several requests in the batch.
+                            ) -> List[dict]: # A list of dictionaries with matched labels, in the same order as `pairs`. Pairs with a failed request are None.
+    """
+    Matches many pairs of cell type label sets through OpenAI's Batch API.
+    """
+
+    # Split each pair's predicted labels into the same shards as `match_cell_labels`, so both share cached results,
+    # and only submit the shards without a cached result
+    shards = [_shards(p, shard_size) for _, p in pairs]
+    results = [[None if force_refresh else _cache_get(_cache_key(e, shard)) for shard in pair_shards]
+               for (e, _), pair_shards in zip(pairs, shards)]
+    pending = [(i, j) for i, pair_results in enumerate(results) for j, json_data in enumerate(pair_results) if json_data is None]
+    if not pending:
+        return [_merge_shards(pair_results) for pair_results in results]
+
+    client = _get_client(_resolve_api_key(openai_api_key))
+
+    # Write one chat completion request per shard to a JSONL file and upload it
+    lines = [json.dumps({"custom_id": f"p{i}s{j}", "method": "POST", "url": "/v1/chat/completions",
+                         "body": _build_request(pairs[i][0], shards[i][j])})
+             for i, j in pending]
+    batch_file = client.files.create(file=("match_cell_labels.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+
+    # Poll until the batch reaches a terminal state
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"The OpenAI batch {batch.id} did not complete (status: {batch.status}).")
+
+    # Download the results and reorder them by their custom id
+    if batch.output_file_id is None:
+        return [_merge_shards(pair_results) for pair_results in results]
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            i, j = map(int, record["custom_id"][1:].split("s"))
+            results[i][j] = _parse_content(response["body"]["choices"][0]["message"]["content"])
+            _cache_put(_cache_key(pairs[i][0], shards[i][j]), results[i][j])
+    return [_merge_shards(pair_results) for pair_results in results]
+
+
+# %% ../nbs/03_Label_Set_harmonisation.ipynb 10
 def map_labels_to_categories(label_list: list, # A list of labels that need to be categorized
                              label_dict: dict # A dictionary where keys are categories and values are lists of labels belonging to those categories
                              ) -> list: # Returns a list of categories corresponding to each label in `label_list`.
@@ -83,15 +417,10 @@ def map_labels_to_categories(label_list: list, # A list of labels that need to b
     """
     Maps each label in `label_list` to its corresponding category based on `label_dict`.
     """
-    label_to_category = {}
-
     # Constructing a mapping from label to category
-    for category, labels in label_dict.items():
-        if isinstance(labels, list):
-            for label in labels:
-                label_to_category[label] = category
-        else:
-            label_to_category[labels] = category
+    label_to_category = {label: category
+                         for category, labels in label_dict.items()
+                         for label in (labels if isinstance(labels, (list, tuple, set)) else (labels,))}
 
     # Mapping each label in the label_list to its category
     mapped_list = [label_to_category.get(label, "unknown") for label in label_list]
@@ -3,156 +3,472 @@
 # %% auto 0
 __all__ = ['knn_majority_voting', 'knn_weighted_voting', 'calculate_centroids', 'assign_labels_by_nearest_centroid', 'labels']
 
-# %% ../nbs/02_KNN_Label_transfer.ipynb 5
+# %% ../nbs/02_KNN_Label_transfer.ipynb 3
+import time
+import warnings
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import faiss
+
+
+# %% ../nbs/02_KNN_Label_transfer.ipynb 6
 from typing import List as List
-from collections import Counter
+from typing import Tuple as Tuple
+
+
+def _array_module(array):
+    "Returns `cupy` for CuPy arrays and `numpy` otherwise, only importing CuPy when it is already in use."
+    if type(array).__module__.startswith('cupy'):
+        import cupy
+        return cupy
+    return np
+
+
+def _encode_labels(reference_labels: List # A list of labels corresponding to the points in the reference dataset.
+                   ) -> Tuple[np.ndarray, np.ndarray]: # Returns the distinct labels and an (n_reference,) int32 array of the index of each point's label among them.
+    "Encodes labels as integer codes. A categorical `reference_labels`, such as an AnnData `obs` column, is reused without re-encoding its values."
+    categorical = pd.Categorical(reference_labels).remove_unused_categories()
+    classes = categorical.categories.to_numpy()
+    codes = categorical.codes.astype(np.int32)
+    if (codes < 0).any():
+        # Missing labels are transferred like any other label.
+        codes[codes < 0] = len(classes)
+        classes = np.append(classes.astype(object), np.nan)
+    return classes, codes
+
+
+@lru_cache(maxsize=None)
+def _numba_vote_kernel():
+    "Compiles the Numba kernel shared by majority and weighted voting, caching it on disk across processes. Numba is only imported when it is requested."
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def vote(codes, weights, out):
+        # For each query point, score every neighbor by the total weight of the neighbors sharing its label
+        # and keep the first, i.e. closest, neighbor with the highest score. Since k is small this needs
+        # no per-row hashmap or (n_query, n_labels) score matrix.
+        for i in prange(codes.shape[0]):
+            best, best_score = 0, -np.inf
+            for j in range(codes.shape[1]):
+                score = 0.0
+                for m in range(codes.shape[1]):
+                    if codes[i, m] == codes[i, j]:
+                        score += weights[i, m]
+                if score > best_score:
+                    best, best_score = j, score
+            out[i] = codes[i, best]
 
-def knn_majority_voting(indices: List[List[int]], # A list of lists, where each sublist contains the indices of the k-nearest neighbors in the reference dataset for a given query point.
-                        reference_labels: List[str] # A list of labels corresponding to the points in the reference dataset.
+    return vote
+
+
+def _majority_vote(codes: np.ndarray, # An (n_query, k) array of the label codes of each query point's neighbors, closest first.
+                   out: np.ndarray, # An (n_query,) array the winning label code of each query point is written to.
+                   use_numba: bool = False # Whether to count the votes with a parallel Numba kernel. Ignored for CuPy arrays.
+                   ) -> np.ndarray: # Returns `out`.
+    "Writes the most common label code of each row of `codes` to `out`, breaking ties in favour of the closest neighbor. Runs on the GPU for CuPy arrays."
+    xp = _array_module(codes)
+    if use_numba and xp is np:
+        _numba_vote_kernel()(codes, np.ones(codes.shape, dtype=np.float32), out)
+        return out
+
+    # For each neighbor, count how many neighbors of the same query point share its label.
+    votes = xp.zeros(codes.shape, dtype=xp.int32)
+    for j in range(codes.shape[1]):
+        votes += codes == codes[:, j:j + 1]
+
+    # argmax picks the first, i.e. closest, neighbor among tied labels.
+    out[:] = codes[xp.arange(codes.shape[0]), votes.argmax(axis=1)]
+    return out
+
+
+def knn_majority_voting(indices: np.ndarray, # An array of shape (n_query, k), where each row contains the indices of the k-nearest neighbors in the reference dataset for a given query point.
+                        reference_labels: List[str], # A list of labels corresponding to the points in the reference dataset.
+                        use_numba: bool = False # Whether to count the votes with a parallel Numba kernel.
                         ) -> List[str]: # A list of labels for each point in the query dataset, determined by majority voting.
     """
     Assigns labels to query dataset points using majority voting from k-nearest neighbors.
     """
-    query_labels = []
-    for ind in indices:
-        neighbor_labels = [reference_labels[i] for i in ind]
-        label_counts = Counter(neighbor_labels)
-        most_common_label = label_counts.most_common(1)[0][0]
-        query_labels.append(most_common_label)
-    return query_labels
+    indices = np.asarray(indices)
 
+    # Encode the neighbor labels as integer codes, giving an (n_query, k) matrix.
+    classes, reference_codes = _encode_labels(reference_labels)
+    codes = reference_codes[indices]
 
-# %% ../nbs/02_KNN_Label_transfer.ipynb 7
+    most_common = _majority_vote(codes, np.empty(codes.shape[0], dtype=codes.dtype), use_numba)
+    return classes[most_common].tolist()
+
+
+# %% ../nbs/02_KNN_Label_transfer.ipynb 8
 from typing import List as List
 from typing import Dict as Dict
-from collections import Counter
 
-def knn_weighted_voting(indices: List, # A list of lists, where each sublist contains the indices of the k-nearest neighbors in the reference dataset for a given query point.
-                        distances: List, # A list of lists, where each sublist contains the distances of the k-nearest neighbors from a given query point.
-                        reference_labels: List # A list of labels corresponding to the points in the reference dataset.
+def _weighted_vote(codes: np.ndarray, # An (n_query, k) array of the label codes of each query point's neighbors.
+                   weights: np.ndarray, # An (n_query, k) array of the weight of each neighbor's vote.
+                   n_classes: int, # The number of distinct label codes.
+                   out: np.ndarray, # An (n_query,) array the winning label code of each query point is written to.
+                   max_scores_size: int = 2**26, # The maximum number of entries in the (rows, labels) score matrix accumulated at once. Larger inputs are processed in row chunks.
+                   use_numba: bool = False # Whether to accumulate the votes with a parallel Numba kernel, which needs no score matrix. Ignored for CuPy arrays.
+                   ) -> np.ndarray: # Returns `out`.
+    "Writes the label code with the highest total weight in each row of `codes` to `out`, breaking ties in favour of the closest neighbor. Runs on the GPU for CuPy arrays."
+    xp = _array_module(codes)
+    if use_numba and xp is np:
+        _numba_vote_kernel()(codes, weights, out)
+        return out
+    if xp is np:
+        scatter_add = np.add.at
+    else:
+        from cupyx import scatter_add
+
+    # Accumulate the weights of each label into a dense (rows, labels) score matrix, in row chunks to bound memory.
+    chunk_size = max(1, max_scores_size // n_classes)
+    for start in range(0, codes.shape[0], chunk_size):
+        chunk_codes = codes[start:start + chunk_size]
+        scores = xp.zeros((chunk_codes.shape[0], n_classes), dtype=xp.float32)
+        rows = xp.broadcast_to(xp.arange(chunk_codes.shape[0])[:, None], chunk_codes.shape)
+        scatter_add(scores, (rows, chunk_codes), weights[start:start + chunk_size])
+        # Score each neighbor by the total weight of its label. argmax picks the first, i.e. closest, neighbor among tied labels.
+        neighbor_scores = scores[rows, chunk_codes]
+        out[start:start + chunk_size] = chunk_codes[xp.arange(chunk_codes.shape[0]), neighbor_scores.argmax(axis=1)]
+    return out
+
+
+def knn_weighted_voting(indices: np.ndarray, # An array of shape (n_query, k), where each row contains the indices of the k-nearest neighbors in the reference dataset for a given query point.
+                        distances: np.ndarray, # An array of shape (n_query, k), where each row contains the distances of the k-nearest neighbors from a given query point.
+                        reference_labels: List, # A list of labels corresponding to the points in the reference dataset.
+                        max_scores_size: int = 2**26, # The maximum number of entries in the (rows, labels) score matrix accumulated at once. Larger inputs are processed in row chunks.
+                        use_numba: bool = False # Whether to accumulate the votes with a parallel Numba kernel, which needs no score matrix.
                         ) -> List[str]: # A list of labels for each point in the query dataset, determined by weighted voting.
     """
     Assigns labels to query dataset points using weighted voting from k-nearest neighbors.
     """
-    query_labels = []
-    for ind, dist in zip(indices, distances):
-        weighted_votes: Dict[str, float] = {}
-        for i, d in zip(ind, dist):
-            label = reference_labels[i]
-            weight = 1 / (d + 1e-6)  # Adding a small constant to avoid division by zero
-            weighted_votes[label] = weighted_votes.get(label, 0) + weight
-        most_common_label = max(weighted_votes, key=weighted_votes.get)
-        query_labels.append(most_common_label)
-    return query_labels
-
-
-# %% ../nbs/02_KNN_Label_transfer.ipynb 9
-import numpy as np
-from collections import defaultdict, Counter
+    indices = np.asarray(indices)
+    weights = 1 / (np.asarray(distances, dtype=np.float32) + 1e-6)  # Adding a small constant to avoid division by zero
+
+    # Encode the neighbor labels as integer codes, giving an (n_query, k) matrix.
+    classes, reference_codes = _encode_labels(reference_labels)
+    codes = reference_codes[indices]
+
+    most_weighted = _weighted_vote(codes, weights, len(classes), np.empty(codes.shape[0], dtype=codes.dtype),
+                                   max_scores_size, use_numba)
+    return classes[most_weighted].tolist()
+
+
+# %% ../nbs/02_KNN_Label_transfer.ipynb 11
+from typing import Tuple as Tuple
+from typing import Union as Union
 
 
-def calculate_centroids(reference_data: List[List[float]], # A list of lists, where each sublist represents a data point in the reference dataset.
-                        reference_labels: List[str] # A list of labels corresponding to the points in the reference dataset.
-                        ) -> Dict[str, np.ndarray]: # Returns a dictionary where each key is a label and the corresponding value is the centroid of that label.
+def _centroids(reference_data: np.ndarray, # An array of shape (n_reference, d), where each row represents a data point in the reference dataset.
+               codes: np.ndarray, # An (n_reference,) array of the label code of each reference data point.
+               n_classes: int, # The number of distinct label codes. Every code must occur at least once.
+               chunk_size: int = 8192 # The number of reference data points summed per matrix product.
+               ) -> np.ndarray: # Returns an (n_classes, d) array where row `i` is the centroid of the label with code `i`.
+    "Calculates the centroid of each label code in the reference dataset."
+    # Sum the data points of each label in a single pass over the reference dataset. Each chunk of rows is
+    # summed per label with one product against its sparse one-hot label matrix, which costs O(chunk_size * d)
+    # however many labels there are, and accumulated in float64.
+    dtype = np.result_type(reference_data.dtype, np.float32)
+    label_sums = np.zeros((n_classes, reference_data.shape[1]), dtype=np.float64)
+    for start in range(0, reference_data.shape[0], chunk_size):
+        chunk_codes = codes[start:start + chunk_size]
+        one_hot = sp.csr_matrix((np.ones(len(chunk_codes), dtype=dtype), (chunk_codes, np.arange(len(chunk_codes)))),
+                                shape=(n_classes, len(chunk_codes)))
+        label_sums += one_hot @ reference_data[start:start + chunk_size].astype(dtype, copy=False)
+
+    # Calculate the centroid for each label by dividing the sum of data points for that label by the count of that label.
+    label_counts = np.bincount(codes, minlength=n_classes)
+    return label_sums / label_counts[:, None]
+
+
+def calculate_centroids(reference_data: np.ndarray, # An array of shape (n_reference, d), where each row represents a data point in the reference dataset.
+                        reference_labels: List[str], # A list of labels corresponding to the points in the reference dataset.
+                        as_arrays: bool = False, # Whether to return the labels and centroids as a `(classes, centroids)` pair of arrays instead of a dictionary.
+                        chunk_size: int = 8192 # The number of reference data points summed per matrix product.
+                        ) -> Union[Dict[str, np.ndarray], Tuple[np.ndarray, np.ndarray]]: # Returns a dictionary where each key is a label and the corresponding value is the centroid of that label, or a `(classes, centroids)` pair if `as_arrays` is True.
     """
     Calculates the centroids for each label in the reference dataset.
     """
-    
+    reference_data = np.asarray(reference_data)
 
-    # Initialize a dictionary to store the sum of data points for each label.
-    label_sums = defaultdict(lambda: np.zeros(len(reference_data[0])))
-    
-    # Count the number of occurrences of each label in the reference dataset.
-    label_counts = Counter(reference_labels)
-    
-    # For each data point and its corresponding label in the reference dataset,
-    # add the data point to the sum of data points for that label.
-    for data, label in zip(reference_data, reference_labels):
-        label_sums[label] += np.array(data)
-    
-    # Calculate the centroid for each label by dividing the sum of data points for that label by the count of that label.
-    centroids = {label: label_sums[label] / count for label, count in label_counts.items()}
-    
-    return centroids
+    # Encode the labels as integer codes, one per reference data point.
+    classes, codes = _encode_labels(reference_labels)
+    centroids = _centroids(reference_data, codes, len(classes), chunk_size)
 
+    if as_arrays:
+        return classes, centroids
+    return {label: centroids[i] for i, label in enumerate(classes.tolist())}
 
-# %% ../nbs/02_KNN_Label_transfer.ipynb 10
-def assign_labels_by_nearest_centroid(query_data: List[List[float]], # A list of lists, where each sublist represents a data point in the query dataset.
-                                      centroids: Dict[str, np.ndarray] # A dictionary where each key is a label and the corresponding value is the centroid of that label.
+
+# %% ../nbs/02_KNN_Label_transfer.ipynb 12
+def assign_labels_by_nearest_centroid(query_data: np.ndarray, # An array of shape (n_query, d), where each row represents a data point in the query dataset.
+                                      centroids: Dict[str, np.ndarray], # A dictionary where each key is a label and the corresponding value is the centroid of that label.
+                                      batch_size: int = 8192, # The number of query data points compared against the centroids at once.
+                                      use_gpu: bool = False # Whether to compute the distances on the GPU with CuPy.
                                       ) -> List[str]: # Returns a list of labels assigned to each point in the query dataset based on the nearest centroid.
     """
     Assigns labels to each point in the query dataset based on the nearest centroid.
     """
-    # Initialize an empty list to store the labels for the query data points.
-    query_labels = []
-    
-    # For each data point in the query dataset,
-    for data in query_data:
-        # Convert the data point to a numpy array.
-        data_point = np.array(data)
-        
-        # Find the label of the centroid closest to the data point.
-        # The closest centroid is the one with the least Euclidean distance from the data point.
-        closest_label = min(centroids.keys(), key=lambda label: np.linalg.norm(data_point - centroids[label]))
-        
-        # Append the label of the closest centroid to the list of labels for the query data points.
-        query_labels.append(closest_label)
-    
-    # Return the list of labels for the query data points.
-    return query_labels
+    if use_gpu:
+        import cupy as xp
+    else:
+        xp = np
 
-# %% ../nbs/02_KNN_Label_transfer.ipynb 12
+    # Stack the centroids into a (n_labels, d) matrix in the precision of the query data.
+    query_data = np.asarray(query_data)
+    dtype = np.result_type(query_data.dtype, np.float32)
+    centroid_labels = list(centroids.keys())
+    centroid_matrix = xp.asarray(np.stack(list(centroids.values())), dtype=dtype)
+    centroid_norms = (centroid_matrix ** 2).sum(axis=1)
+
+    # The closest centroid is the one with the least Euclidean distance from the data point. Since
+    # ||q - c||^2 = ||q||^2 + ||c||^2 - 2 q.c and ||q||^2 is the same for every centroid, it is enough
+    # to minimise ||c||^2 - 2 q.c, which is a single matrix product per batch of query data points.
+    closest = np.empty(query_data.shape[0], dtype=np.intp)
+    for start in range(0, query_data.shape[0], batch_size):
+        batch = xp.asarray(query_data[start:start + batch_size], dtype=dtype)
+        distances = centroid_norms - 2 * batch @ centroid_matrix.T
+        batch_closest = distances.argmin(axis=1)
+        closest[start:start + batch_size] = batch_closest.get() if use_gpu else batch_closest
+
+    return [centroid_labels[i] for i in closest]
+
+
+# %% ../nbs/02_KNN_Label_transfer.ipynb 15
 from typing import List, Optional, Union, Tuple
 
 
-def labels(embedding_array_reference: np.ndarray, # A numpy array representing the reference dataset.
-                       embedding_array_query: np.ndarray, # A numpy array representing the query dataset.
+def _as_faiss_array(array: np.ndarray, # The embeddings to pass to FAISS.
+                    name: str # The name of the argument, used in the warning.
+                    ) -> np.ndarray: # A C-contiguous float32 or float16 view or copy of `array`.
+    "Returns `array` as a C-contiguous float32 or float16 array, warning when this needs a copy."
+    array = np.asarray(array)
+    if array.dtype not in (np.float32, np.float16) or not array.flags['C_CONTIGUOUS']:
+        warnings.warn(f"`{name}` was copied to a C-contiguous float32 array for FAISS. "
+                      f"Pass it in that layout to avoid the extra memory.", stacklevel=3)
+        return np.ascontiguousarray(array, dtype=np.float32)
+    return array
+
+
+def _float32(array: np.ndarray # A chunk of float32 or float16 embeddings.
+             ) -> np.ndarray: # `array` itself if it is float32, otherwise a float32 copy.
+    "Casts a chunk of embeddings to the float32 FAISS requires, so that float16 embeddings are only widened one chunk at a time."
+    return np.ascontiguousarray(array, dtype=np.float32)
+
+
+def _add(index, # The FAISS index to add the embeddings to.
+         embeddings: np.ndarray, # The float32 or float16 embeddings to add.
+         chunk_size: int = 65536 # The number of embeddings cast to float32 and added at once.
+         ):
+    "Adds embeddings to `index` in chunks, so float16 embeddings are never fully copied to float32."
+    for start in range(0, embeddings.shape[0], chunk_size):
+        index.add(_float32(embeddings[start:start + chunk_size]))
+
+
+_gpu_resources = None
+
+
+def _get_gpu_resources():
+    "Returns the FAISS GPU resources shared across calls, so that their temporary memory pool is allocated once and reused."
+    global _gpu_resources
+    if _gpu_resources is None:
+        _gpu_resources = faiss.StandardGpuResources()
+    return _gpu_resources
+
+
+def _flat_index(dimension: int, # The dimension of the indexed vectors.
+                distance_metric: str = 'L2', # The distance metric to use. Can be 'L2' or 'IP'.
+                use_gpu: bool = False, # Whether to build the index on the GPU.
+                use_float16: bool = False # Whether a GPU index stores its vectors in float16.
+                ):
+    "Builds an exact (flat) FAISS index, on the GPU if requested."
+    metric = faiss.METRIC_L2 if distance_metric == 'L2' else faiss.METRIC_INNER_PRODUCT
+    if not use_gpu:
+        return faiss.IndexFlat(dimension, metric)
+    config = faiss.GpuIndexFlatConfig()
+    config.useFloat16 = use_float16
+    return faiss.GpuIndexFlat(_get_gpu_resources(), dimension, metric, config)
+
+
+def _search_to_gpu(index, # The FAISS index to search.
+                   batch_query: np.ndarray, # A batch of query embeddings in host memory.
+                   k: int, # The number of nearest neighbors to search for.
+                   distances, # A CuPy array of shape (n, k) the distances are written to.
+                   indices # A CuPy array of shape (n, k) the neighbor indices are written to.
+                   ):
+    "Searches `index`, writing the results into CuPy arrays. GPU indexes write them directly to device memory, without a round trip through the host."
+    import cupy as cp
+
+    if not isinstance(index, getattr(faiss, 'GpuIndex', ())):
+        batch_distances, batch_indices = index.search(_float32(batch_query), k)
+        distances[:], indices[:] = cp.asarray(batch_distances), cp.asarray(batch_indices)
+        return
+    # float16 queries are copied to the GPU at half size and only widened to float32 there.
+    batch_query = cp.ascontiguousarray(cp.asarray(batch_query), dtype=cp.float32)
+    # FAISS runs on its own stream, so wait for the query copy before the search and for the search before using its results.
+    cp.cuda.runtime.deviceSynchronize()
+    index.search_c(batch_query.shape[0], faiss.cast_integer_to_float_ptr(batch_query.data.ptr), k,
+                   faiss.cast_integer_to_float_ptr(distances.data.ptr), faiss.cast_integer_to_idx_t_ptr(indices.data.ptr))
+    cp.cuda.runtime.deviceSynchronize()
+
+
+def _search(index, # The FAISS index to search.
+            batch_query: np.ndarray, # A batch of float32 or float16 query embeddings in host memory.
+            k: int, # The number of nearest neighbors to search for.
+            distances, # An array of shape (n, k) the distances are written to. A CuPy array if `to_gpu`.
+            indices, # An array of shape (n, k) the neighbor indices are written to. A CuPy array if `to_gpu`.
+            to_gpu: bool = False, # Whether to write the results into CuPy arrays with `_search_to_gpu`.
+            chunk_size: int = 65536 # The number of float16 query embeddings cast to float32 and searched at once.
+            ):
+    "Searches `index` for a batch of queries, casting float16 queries to float32 a chunk at a time regardless of the batch size."
+    if batch_query.dtype != np.float16:
+        chunk_size = batch_query.shape[0] or 1
+    for start in range(0, batch_query.shape[0], chunk_size):
+        chunk = batch_query[start:start + chunk_size]
+        chunk_distances, chunk_indices = distances[start:start + chunk_size], indices[start:start + chunk_size]
+        if to_gpu:
+            _search_to_gpu(index, chunk, k, chunk_distances, chunk_indices)
+        else:
+            index.search(_float32(chunk), k, D=chunk_distances, I=chunk_indices)
+
+
+# The code sizes (bytes per vector) and sub-vector dimensions that FAISS GPU IVF-PQ indexes support.
+_GPU_PQ_CODE_SIZES = (1, 2, 3, 4, 8, 12, 16, 20, 24, 28, 32, 40, 48, 56, 64, 96)
+_GPU_PQ_SUB_DIMENSIONS = (1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 24, 28, 32)
+
+
+def _pq_code_size(dimension: int, # The dimension of the indexed vectors.
+                  use_gpu: bool = False # Whether the index will be cloned to the GPU.
+                  ) -> Optional[int]: # The number of sub-vectors, or None if no GPU-supported split of `dimension` exists.
+    "Chooses the number of 8-bit sub-vectors of an IVF-PQ index. Each must divide `dimension`, and on the GPU both their number and size must be supported."
+    if not use_gpu:
+        return next(m for m in range(min(32, dimension), 0, -1) if dimension % m == 0)
+    return next((m for m in reversed(_GPU_PQ_CODE_SIZES)
+                 if dimension % m == 0 and dimension // m in _GPU_PQ_SUB_DIMENSIONS), None)
+
+
+def _reference_index(embedding_array_reference: np.ndarray, # A numpy array representing the reference dataset.
+                     distance_metric: str = 'L2', # The distance metric to use. Can be 'L2' or 'IP'.
+                     index_type: str = 'flat', # The FAISS index to use. Can be 'flat', 'ivf_pq' or 'hnsw'.
+                     use_gpu: bool = False, # Whether to build the index on the GPU. HNSW indexes are always built on the CPU.
+                     use_float16: bool = False # Whether a GPU index stores its vectors (or, for 'ivf_pq', its lookup tables) in float16.
+                     ):
+    "Builds a FAISS index over the reference dataset, training it first if `index_type` is approximate."
+    num_reference_points, dimension = embedding_array_reference.shape
+    metric = faiss.METRIC_L2 if distance_metric == 'L2' else faiss.METRIC_INNER_PRODUCT
+    if index_type == 'flat':
+        index = _flat_index(dimension, distance_metric, use_gpu, use_float16)
+        _add(index, embedding_array_reference)
+        return index
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, 32, metric)
+        index.hnsw.efSearch = 64
+        _add(index, embedding_array_reference)
+        return index
+    if index_type != 'ivf_pq':
+        raise ValueError("Invalid index type. Choose 'flat', 'ivf_pq' or 'hnsw'.")
+    if num_reference_points < 256:
+        raise ValueError(f"index_type='ivf_pq' needs at least 256 reference points to train its 8-bit product quantizer, "
+                         f"but the reference dataset has {num_reference_points}. Use index_type='flat' instead.")
+
+    # Each vector is split into sub-vectors, which must divide its dimension, and each sub-vector is quantized to an 8-bit code.
+    nlist = max(1, min(4096, num_reference_points // 39))
+    m = _pq_code_size(dimension, use_gpu)
+    if use_gpu and m is None:
+        warnings.warn(f"FAISS GPU IVF-PQ indexes cannot split {dimension}-dimensional embeddings into supported sub-vectors, "
+                      f"so the 'ivf_pq' index is searched on the CPU.", stacklevel=3)
+        use_gpu, m = False, _pq_code_size(dimension)
+    quantizer = faiss.IndexFlat(dimension, metric)
+    index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, 8, metric)
+    index.train(_float32(embedding_array_reference))
+    _add(index, embedding_array_reference)
+    index.nprobe = 16
+    if use_gpu:
+        options = faiss.GpuClonerOptions()
+        options.useFloat16 = use_float16
+        index = faiss.index_cpu_to_gpu(_get_gpu_resources(), 0, index, options)
+    return index
+
+
+def labels(embedding_array_reference: np.ndarray, # A numpy array representing the reference dataset. Should be C-contiguous float32 or float16, otherwise it is copied with a warning. float16 embeddings are cast to float32 a chunk at a time.
+                       embedding_array_query: np.ndarray, # A numpy array representing the query dataset. Should be C-contiguous float32 or float16, otherwise it is copied with a warning. float16 embeddings are cast to float32 a chunk at a time, independently of `batch_size`.
                        reference_labels: List[str], # A list of labels for the reference dataset.
                        k: int = 1, # The number of nearest neighbors to consider for label assignment.
                        use_gpu: bool = True, # Whether to use GPU for computation.
                        batch_size: Optional[int] = None, # The size of the batch for computation. If None, the entire query dataset is processed in one batch.
                        distance_metric: str = 'L2', # The distance metric to use. Can be 'L2' or 'IP'.
                        label_consensus: str = 'majority_voting', # The label consensus method to use. Can be 'majority_voting', 'weighted_voting', or 'centroid_based'.
-                       timed: bool = False # Whether to return the time taken for label transfer.
-                       ) -> Union[List[str], Tuple[List[str], float]]: # Returns a list of labels for the query dataset. If timed is True, also returns the time taken for label transfer.
+                       timed: bool = False, # Whether to return the time taken for label transfer.
+                       use_numba: bool = False, # Whether to run 'majority_voting' and 'weighted_voting' with a parallel Numba kernel.
+                       use_float16: bool = False, # Whether the GPU index stores the reference embeddings in float16, halving its memory and bandwidth. Ignored on the CPU.
+                       index_type: str = 'flat', # The FAISS index to search. Can be 'flat' (exact), 'ivf_pq' or 'hnsw' (approximate, for large reference datasets).
+                       gpu_consensus: bool = False # Whether to keep the search results on the GPU and compute the label consensus there with CuPy. Intended for use with `use_gpu`.
+                       ) -> Union[List[str], Tuple[List[str], float]]: # Returns a list of labels for the query dataset, with NaN for query points for which no neighbor was found. If timed is True, also returns the time taken for label transfer.
     
     "Transfers labels from a reference dataset to a query dataset using FAISS."
     
-    
-    from collections import Counter, defaultdict
-    import numpy as np
-    import faiss
-    import time
-    
     start_time = time.time()
+    embedding_array_reference = _as_faiss_array(embedding_array_reference, 'embedding_array_reference')
+    embedding_array_query = _as_faiss_array(embedding_array_query, 'embedding_array_query')
     dimension = embedding_array_reference.shape[1]
-    res = faiss.StandardGpuResources() if use_gpu else None
-    if use_gpu:
-        res.noTempMemory()
-    if distance_metric == 'L2':
-        index = faiss.GpuIndexFlatL2(res, dimension) if use_gpu else faiss.IndexFlatL2(dimension)
-    elif distance_metric == 'IP':
-        index = faiss.GpuIndexFlatIP(res, dimension) if use_gpu else faiss.IndexFlatIP(dimension)
-    else:
+    if distance_metric not in ('L2', 'IP'):
         raise ValueError("Invalid distance metric. Choose 'L2' or 'IP'.")
-    index.add(embedding_array_reference)
+    if index_type not in ('flat', 'ivf_pq', 'hnsw'):
+        raise ValueError("Invalid index type. Choose 'flat', 'ivf_pq' or 'hnsw'.")
+
+    # Encode the reference labels once as integer codes, which is all the voting and centroid computations need.
+    classes, reference_codes = _encode_labels(reference_labels)
+
+    if label_consensus == 'centroid_based':
+        # Query points are matched to the nearest label centroid, so the index holds the centroids rather than the reference dataset.
+        centroids = _centroids(embedding_array_reference, reference_codes, len(classes))
+        index = _flat_index(dimension, 'L2', use_gpu)
+        index.add(np.ascontiguousarray(centroids, dtype=np.float32))
+    else:
+        index = _reference_index(embedding_array_reference, distance_metric, index_type, use_gpu, use_float16)
     num_query_points = embedding_array_query.shape[0]
     batch_size = batch_size or num_query_points
-    query_labels = []
+    search_k = 1 if label_consensus == 'centroid_based' else k
+
+    if gpu_consensus:
+        # The label codes and all per-batch buffers live on the GPU, and only the final query codes are copied back.
+        import cupy as xp
+        reference_codes = xp.asarray(reference_codes)
+    else:
+        xp = np
+
+    # Write each batch in place into buffers allocated once, rather than growing a list of labels.
+    query_codes = xp.empty(num_query_points, dtype=xp.int32)
+    no_neighbor = len(classes)
+    distances = xp.empty((min(batch_size, num_query_points), search_k), dtype=xp.float32)
+    indices = xp.empty((min(batch_size, num_query_points), search_k), dtype=xp.int64)
     for i in range(0, num_query_points, batch_size):
         batch_query = embedding_array_query[i:i + batch_size]
-        distances, indices = index.search(batch_query, k)
-        if k > 1 and label_consensus == 'majority_voting':
-            batch_labels = knn_majority_voting(indices, reference_labels)
+        n = batch_query.shape[0]
+        _search(index, batch_query, search_k, distances[:n], indices[:n], gpu_consensus)
+        out = query_codes[i:i + n]
+        # Approximate indexes, or a `k` larger than the reference dataset, return -1 for missing neighbors. They get the
+        # `no_neighbor` code and cast no vote, so a query point only gets it if none of its neighbors were found.
+        missing = indices[:n] < 0
+        codes = indices[:n] if label_consensus == 'centroid_based' else reference_codes[indices[:n]]
+        codes[missing] = no_neighbor
+        if k > 1 and label_consensus == 'majority_voting' and missing.any():
+            _weighted_vote(codes, (~missing).astype(xp.float32), no_neighbor + 1, out, use_numba=use_numba)
+        elif k > 1 and label_consensus == 'majority_voting':
+            _majority_vote(codes, out, use_numba)
         elif k > 1 and label_consensus == 'weighted_voting':
-            batch_labels = knn_weighted_voting(indices, distances, reference_labels)
-        elif label_consensus == 'centroid_based':
-            if i == 0:  # Calculate centroids only once
-                centroids = calculate_centroids(embedding_array_reference, reference_labels)
-            batch_labels = assign_labels_by_nearest_centroid(batch_query, centroids)
+            weights = 1 / (distances[:n] + 1e-6)  # Adding a small constant to avoid division by zero
+            weights[missing] = 0
+            _weighted_vote(codes, weights, no_neighbor + 1, out, use_numba=use_numba)
         else:
-            batch_labels = [reference_labels[i[0]] for i in indices]
-        query_labels.extend(batch_labels)
+            out[:] = codes[:, 0]
+    if gpu_consensus:
+        query_codes = xp.asnumpy(query_codes)
+    if (query_codes == no_neighbor).any():
+        classes = np.append(classes.astype(object), np.nan)
+    query_labels = classes[query_codes].tolist()
     end_time = time.time()
     duration_minutes = (end_time - start_time) / 60
     if timed: